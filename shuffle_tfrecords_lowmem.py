@@ -5,15 +5,46 @@ import os
 import sys
 import glob
 import random
+import operator
+import functools
+import itertools
+import array
+import queue
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
 
 import argparse
-import hashlib
 import logging
 
+import mmap
+import resource
 import zlib
-import pickle
+import heapq
+import struct
+
+import numpy as np
+import xxhash
+import zstandard as zstd
+
+try:
+	import numba # Optional, compiles the label extraction loop used with --step=-1 --no_mem_compression
+except ImportError:
+	numba = None
+
+try:
+	import crc32c # Optional, required by --output_threads
+except ImportError:
+	crc32c = None
+
+try:
+	from _hashlib import openssl_sha1 as sha1 # Skip the hashlib dispatcher, OpenSSL uses the CPU SHA extensions (SHA-NI, ARMv8) when available
+except ImportError:
+	from hashlib import sha1
 
 import tensorflow.compat.v1 as tf
+from google.protobuf.internal import api_implementation
 
 def parse_cmdline(argv):
 
@@ -24,313 +55,753 @@ def parse_cmdline(argv):
 	parser.add_argument('--output_dataset_config_pbtxt', help='Optional.  If set, print out a human-readable version of DeepVariantDatasetConfig.')
 	parser.add_argument('--output_dataset_name', help='Optional unless --output_dataset_config_pbtxt is set.')
 	parser.add_argument('--direct_num_workers', help='Optional. If set, output will be split in that many worker files.', type=int, default=1)
+	parser.add_argument('--num_readers', help='Optional. Number of processes reading the input files in parallel. Each process loads its own copy of TensorFlow so more than 1 costs memory.', type=int, default=1)
 	parser.add_argument('--step', help='Optional. Configure how many TF records can be loaded in memory at once. -1 is all of them.', type=int, default=-1)
+	parser.add_argument('--no_tmp_compression', help='Optional. If set, records are written uncompressed to the tmp files used when --step is smaller than the number of records.', action='store_true')
+	parser.add_argument('--no_mem_compression', help='Optional. If set, records are kept uncompressed in memory when --step=-1: faster but takes as much RAM as the decompressed input.', action='store_true')
+	parser.add_argument('--tmp_dir', help='Optional. Directory of the tmp files used when --step is smaller than the number of records, e.g. /dev/shm for tmpfs. Default is the directory of --output_pattern_prefix.', default=None)
+	parser.add_argument('--compression_level', help='Optional. GZIP compression level of the output TF records, from 1 (fastest) to 9 (smallest).', type=int, choices=range(1, 10), default=1)
+	parser.add_argument('--output_threads', help='Optional. Number of threads compressing each output file, more than 1 requires the crc32c module.', type=int, default=1)
+	parser.add_argument('--shuffle_key', help='Optional. Key used to shuffle the records: xxh3 hash (fast), sha1 hash (same order as previous versions of this script) or random (fastest, seeded random keys).', choices=['xxh3', 'sha1', 'random'], default='xxh3')
+	parser.add_argument('--seed', help='Optional. Seed of the shuffle for --shuffle_key=xxh3 or random, from 0 to 2^64-1, ignored by sha1.', type=int, default=0)
 
 	known_args, pipeline_args = parser.parse_known_args(argv)
 
+	if ((known_args.seed < 0) or (known_args.seed >= (1 << 64))): sys.exit("--seed must be between 0 and 2^64-1. Shuffling aborted.") # Seeds xxh3 and the random keys, both take unsigned 64 bits seeds
+
 	return known_args, pipeline_args
 
-def shuffle_tfrecords(dataset_name, input_filename_pattern_list, input_pattern_list, output_pattern_prefix, output_config_filename, direct_num_workers, step):
+def prefetch(iterable, maxsize=64):
 
-	def sha1(input_bytes):
+	# Consume iterable in a background thread so that producing the items overlaps with the caller processing them
+	q = queue.Queue(maxsize)
+	end = object()
 
-		m = hashlib.sha1()
-		m.update(input_bytes)
+	def produce():
 
-		return m.digest()
+		try:
 
-	def label_example(input_bytes):
+			for item in iterable: q.put((item, None))
 
-		example = tf.train.Example.FromString(input_bytes)
-		label = example.features.feature['label'].int64_list.value[0]
+		except BaseException as e: q.put((end, e))
 
-		return label
+		else: q.put((end, None))
 
-	i = 0
-	num_records = 0
-	records = []
-	lfn = []
-	lrec = []
-	compression = tf.python_io.TFRecordCompressionType.GZIP
+	threading.Thread(target=produce, daemon=True).start()
 
-	# Make sure we process the input files always in the same order
-	for idx, filepattern in enumerate(input_filename_pattern_list): lfn.extend(glob.glob(filepattern))
-		
-	if (len(lfn) == 0): sys.exit("No file found matching input pattern list. Shuffling aborted.")
+	while (True):
 
-	lfn.sort()
+		item, e = q.get()
 
-	# Hash records and compute their labels
-	print("-> Reading input")
+		if (e is not None): raise e
+		if (item is end): return
+
+		yield item
+
+def read_batches(lfn, options, batch_size, verbose=False):
+
+	# Read the TF records of the input files in batches of batch_size records
+	tf_record_iterator = tf.io.tf_record_iterator
 
 	for fn in lfn:
 
-		print("--> Processing " + fn)
+		if (verbose): print("--> Processing " + fn)
 
-		for rec in tf.io.tf_record_iterator(fn, tf.python_io.TFRecordOptions(compression)):
+		it = tf_record_iterator(fn, options)
+		batch = list(itertools.islice(it, batch_size))
 
-			h = sha1(rec)
-			label = label_example(rec)
+		while (len(batch) != 0):
 
-			records.append((h, i, label))
+			yield batch
 
-			if (step == -1): lrec.append(zlib.compress(pickle.dumps(rec)))
+			batch = list(itertools.islice(it, batch_size))
 
-			i += 1
+sha1_digest = operator.methodcaller('digest')
 
-	num_records = i
+def read_varint(buf, pos):
 
-	print("-> Shuffling TF records")
-	records.sort(key=lambda x: x[0]) # Sort record by their sha1 hash
+	# Decode the protobuf varint starting at buf[pos], return its value and the position following it
+	result = 0
+	shift = 0
 
-	# Count how many labels there are (total and per class)
-	print("-> Counting labels")
+	while (True):
 
-	label_counts = {}
-	num_examples = 0
-	num_examples_by_labels = ""
+		b = buf[pos]
+		result |= (b & 0x7f) << shift
+		pos += 1
 
-	for rec in records:
+		if (b < 0x80): return result, pos
 
-		if (rec[2] not in label_counts): label_counts[rec[2]] = 0
+		shift += 7
 
-		label_counts[rec[2]] += 1
+def iter_fields(buf, pos, end):
 
-	for label, count in label_counts.items(): 
+	# Iterate over the fields of the protobuf message serialized in buf[pos:end] without decoding them.
+	# Yield (field number, wire type, start, end) where buf[start:end] is the field payload (varint, fixed or length-delimited bytes)
+	while (pos < end):
 
-		num_examples_by_labels += "# class" + str(label) + ": " + str(count) + '\n'
-		num_examples += count
+		tag, pos = read_varint(buf, pos)
+		wire_type = tag & 0x7
 
-	del label_counts
+		if (wire_type == 0): _, next_pos = read_varint(buf, pos)
+		elif (wire_type == 1): next_pos = pos + 8
+		elif (wire_type == 2): size, pos = read_varint(buf, pos); next_pos = pos + size
+		elif (wire_type == 5): next_pos = pos + 4
+		else: raise ValueError("Unsupported protobuf wire type " + str(wire_type))
 
-	worker_id = 0
-	num_record_worker = 0
-	num_record_total = 0
-	num_records_per_thread = int(num_records / direct_num_workers) + 1
-	num_records_print = int(num_records / 20)
+		yield tag >> 3, wire_type, pos, next_pos
 
-	output_examples = output_pattern_prefix + "-" + "{:05d}".format(worker_id) + "-of-" + "{:05d}".format(direct_num_workers) + ".tfrecord.gz"
-	writer = tf.python_io.TFRecordWriter(output_examples, options=tf.python_io.TFRecordOptions(compression))
+		pos = next_pos
 
-	if (step == -1): # User explicitly instructed to load ALL records in memory
+def parse_label(rec):
 
-		# Write shuffled records to disk
-		print("-> Writing shuffled TF records to output")
+	# Get features.feature['label'].int64_list.value[0] of a serialized tf.train.Example with the protobuf parser
+	return tf.train.Example.FromString(rec).features.feature['label'].int64_list.value[0]
 
-		for rec in records:
+def scan_label(rec):
 
-			zdRec = pickle.loads(zlib.decompress(lrec[rec[1]]))
+	# Same as parse_label() but only the label feature is decoded, the other features (e.g. the encoded image) are skipped
+	# using their length instead of parsing the whole Example. Only faster than the pure Python protobuf backend
+	label = None
 
-			writer.write(zdRec)
+	try:
 
-			num_record_worker += 1
-			num_record_total += 1
+		for field, wire_type, start, end in iter_fields(rec, 0, len(rec)):
 
-			if (num_record_total % num_records_print == 0): print("--> Written " + str(num_record_total) + " / " + str(num_records) + " records to final location")
+			if ((field != 1) or (wire_type != 2)): continue # Example.features
 
-			if (num_record_worker >= num_records_per_thread):
+			for entry, wire_type, entry_start, entry_end in iter_fields(rec, start, end):
 
-				worker_id += 1
-				num_record_worker = 0
+				if ((entry != 1) or (wire_type != 2)): continue # Features.feature map entry: key = 1, value = 2
 
-				writer.close()
+				key = None
+				value = None
 
-				output_examples = output_pattern_prefix + "-" + "{:05d}".format(worker_id) + "-of-" + "{:05d}".format(direct_num_workers) + ".tfrecord.gz"
-				writer = tf.python_io.TFRecordWriter(output_examples, options=tf.python_io.TFRecordOptions(compression))		
-	
-	else: # User explicitely gave the number of TF records that could be loaded in memory at once
+				for field, wire_type, field_start, field_end in iter_fields(rec, entry_start, entry_end):
 
-		# Write shuffled records
-		print("-> Reordering positions of shuffled TF records")
+					if (wire_type != 2): continue
+					if (field == 1): key = rec[field_start:field_end]
+					elif (field == 2): value = (field_start, field_end)
 
-		i = 0
-		pos_shuff = {}
+				if ((key != b'label') or (value is None)): continue
 
-		for rec in records:
+				label = None # A later entry with the same key replaces the previous one
 
-			pos_shuff[rec[1]] = i
-			i += 1
+				for kind, wire_type, list_start, list_end in iter_fields(rec, value[0], value[1]):
 
-		del records # Not required anymore
+					if ((kind != 3) or (wire_type != 2)): continue # Feature.int64_list
 
-		# Write shuffled records to disk
-		print("-> Writing shuffled TF records to output")
+					for field, wire_type, value_start, value_end in iter_fields(rec, list_start, list_end):
 
-		if (step < num_records): # Cannot hold all the TF records in memory at once, need some tmp storage
+						if ((field != 1) or (value_start == value_end)): continue # Int64List.value, packed (wire type 2) or not (wire type 0)
 
-			num_open_files = int(num_records / step) + 1
-			fo = [] # Keep track of opened files
-			bsz = [] # Keep track of the size of byte objects written to disk
-			pos_shuff_bucket = []
+						label, _ = read_varint(rec, value_start)
+						break
 
-			for i in range(0, num_open_files):
+					if (label is not None): break
 
-				fon = output_pattern_prefix + "_tmp_" + str(i) + ".cpickle"
+				if ((label is not None) and (label >= (1 << 63))): label -= (1 << 64) # Negative int64
 
-				fo.append(open(fon, "wb"))
-				pos_shuff_bucket.append([])
-				bsz.append([])
+	except (IndexError, ValueError): label = None
 
-			i = 0
-			lrec = []
-			lrec_pos = []
+	if (label is None): label = parse_label(rec) # Not found or unexpected encoding, fall back to the protobuf parser
 
-			for fn in lfn:
+	return label
 
-				for rec in tf.io.tf_record_iterator(fn, tf.python_io.TFRecordOptions(compression)):
+# The compiled protobuf backends (upb, cpp) parse a whole Example faster than scan_label() skips through it
+label_example = scan_label if (api_implementation.Type() == 'python') else parse_label
 
-					j = pos_shuff[i]
-					zcpRec = zlib.compress(pickle.dumps(rec))
+if (numba is not None): # Compiled version of label_example() working on a whole batch of records at once
 
-					lrec.append(zcpRec)
-					lrec_pos.append((j, i % step))
+	LABEL_KEY = np.frombuffer(b'label', dtype=np.uint8)
 
-					i += 1
-					num_record_total += 1
+	@numba.njit(cache=True, nogil=True)
+	def scan_varint(buf, pos, end):
 
-					if (i % step == 0):
+		result = np.uint64(0)
+		shift = np.uint64(0)
 
-						lrec_pos.sort()
+		while ((pos < end) and (shift < 64)):
 
-						for new_pos, curr_pos in lrec_pos:
-					
-							bucket = int(new_pos / step)
-							sz = fo[bucket].write(lrec[curr_pos])
+			b = buf[pos]
+			result |= np.uint64(b & 0x7f) << shift
+			pos += 1
 
-							pos_shuff_bucket[bucket].append(new_pos)
-							bsz[bucket].append(sz)
+			if (b < 0x80): return result, pos, True
 
-						lrec = []
-						lrec_pos = []
+			shift += np.uint64(7)
 
-					if (num_record_total % num_records_print == 0): print("--> Written " + str(num_record_total) + " / " + str(num_records) + " records to tmp location (1/2)")
+		return result, pos, False
 
-			if (len(lrec) != 0):
+	@numba.njit(cache=True, nogil=True)
+	def scan_field(buf, pos, end):
 
-				lrec_pos.sort()
+		# Same as one iteration of iter_fields(), the last value is False if the field is truncated or unsupported
+		tag, pos, ok = scan_varint(buf, pos, end)
+		wire_type = tag & np.uint64(0x7)
+		next_pos = pos
 
-				for new_pos, curr_pos in lrec_pos:
-			
-					bucket = int(new_pos / step)
-					sz = fo[bucket].write(lrec[curr_pos])
+		if (not ok): return np.uint64(0), wire_type, pos, next_pos, False
 
-					pos_shuff_bucket[bucket].append(new_pos)
-					bsz[bucket].append(sz)
+		if (wire_type == 0): value, next_pos, ok = scan_varint(buf, pos, end)
+		elif (wire_type == 1): next_pos = pos + 8
+		elif (wire_type == 2):
 
-			for i in range(0, num_open_files): fo[i].close()
+			size, pos, ok = scan_varint(buf, pos, end)
+			next_pos = pos + np.int64(size)
 
-			del pos_shuff
+		elif (wire_type == 5): next_pos = pos + 4
+		else: ok = False
 
-			num_record_total = 0
+		return tag >> np.uint64(3), wire_type, pos, next_pos, (ok and (next_pos <= end))
 
-			for i in range(0, num_open_files): 	
+	@numba.njit(cache=True, nogil=True)
+	def scan_labels(buf, offsets):
 
-				fon = output_pattern_prefix + "_tmp_" + str(i) + ".cpickle"
-				fo = open(fon, "rb")
+		# Labels of the records concatenated in buf, record i is buf[offsets[i]:offsets[i+1]]. found[i] is False if label_example() must be used instead
+		num_records = len(offsets) - 1
+		labels = np.zeros(num_records, dtype=np.int64)
+		found = np.zeros(num_records, dtype=np.bool_)
+		for i in range(num_records):
 
-				lrec = []
-				lrec_pos = []
-				j = 0
+			pos = offsets[i]
+			end = offsets[i + 1]
+			ok = True
 
-				for sz in bsz[i]:
+			while (ok and (pos < end)):
 
-					zcRec = bytes(fo.read(sz)) # Read sz bytes from input file, convert to bytes object -> compressed pickled TF record
+				field, wire_type, start, pos, ok = scan_field(buf, pos, end) # Example.features
 
-					lrec.append(zcRec)
-					lrec_pos.append((pos_shuff_bucket[i][j], j))
+				if ((not ok) or (field != 1) or (wire_type != 2)): continue
 
-					j += 1
+				entry_pos = start
 
-				lrec_pos.sort()
+				while (ok and (entry_pos < pos)):
 
-				for new_pos, curr_pos in lrec_pos:
+					entry, wire_type, entry_start, entry_pos, ok = scan_field(buf, entry_pos, pos) # Features.feature map entry
 
-					zdRec = pickle.loads(zlib.decompress(lrec[curr_pos]))
+					if ((not ok) or (entry != 1) or (wire_type != 2)): continue
 
-					writer.write(zdRec)
+					is_label = False
+					value_start = -1
+					value_end = -1
+					field_pos = entry_start
 
-					num_record_worker += 1
-					num_record_total += 1
+					while (ok and (field_pos < entry_pos)):
 
-					if (num_record_total % num_records_print == 0): print("--> Written " + str(num_record_total) + " / " + str(num_records) + " records to final location (2/2)")
+						field, wire_type, field_start, field_pos, ok = scan_field(buf, field_pos, entry_pos)
 
-					if (num_record_worker >= num_records_per_thread):
+						if ((not ok) or (wire_type != 2)): continue
 
-						worker_id += 1
-						num_record_worker = 0
+						if (field == 1): is_label = (field_pos - field_start == len(LABEL_KEY)) and np.all(buf[field_start:field_pos] == LABEL_KEY)
+						elif (field == 2):
 
-						writer.close()
+							value_start = field_start
+							value_end = field_pos
 
-						output_examples = output_pattern_prefix + "-" + "{:05d}".format(worker_id) + "-of-" + "{:05d}".format(direct_num_workers) + ".tfrecord.gz"
-						writer = tf.python_io.TFRecordWriter(output_examples, options=tf.python_io.TFRecordOptions(compression))
+					if ((not ok) or (not is_label) or (value_start < 0)): continue
 
-			print("-> Clean tmp files")
+					found[i] = False # A later entry with the same key replaces the previous one
+					list_pos = value_start
 
-			for i in range(0, num_open_files):
+					while (ok and (not found[i]) and (list_pos < value_end)):
 
-				fon = output_pattern_prefix + "_tmp_" + str(i) + ".cpickle"
-				os.remove(fon)
+						kind, wire_type, list_start, list_pos, ok = scan_field(buf, list_pos, value_end) # Feature.int64_list
 
-		else:
+						if ((not ok) or (kind != 3) or (wire_type != 2)): continue
 
-			i = 0
-			lrec = []
-			lrec_pos = []
+						value_pos = list_start
 
-			for fn in lfn:
+						while (ok and (value_pos < list_pos)):
 
-				for rec in tf.io.tf_record_iterator(fn, tf.python_io.TFRecordOptions(compression)):
+							field, wire_type, int_start, value_pos, ok = scan_field(buf, value_pos, list_pos) # Int64List.value
 
-					j = pos_shuff[i]
-					zcRec = zlib.compress(pickle.dumps(rec))
+							if ((not ok) or (field != 1) or (int_start == value_pos)): continue
 
-					lrec.append(zcRec)
-					lrec_pos.append((j, i))
+							value, _, ok = scan_varint(buf, int_start, value_pos)
 
-					i += 1
-					num_record_total += 1
+							if (ok):
 
-					if (num_record_total % num_records_print == 0): print("--> Loaded " + str(num_record_total) + " / " + str(num_records) + " records in memory (1/2)")
+								labels[i] = np.int64(value) # Wraps around for negative int64
+								found[i] = True
 
-			del pos_shuff
+							break
 
-			lrec_pos.sort()
+			if (not ok): found[i] = False
 
-			num_record_total = 0
+		return labels, found
 
-			for new_pos, curr_pos in lrec_pos:
+def label_arena(arena, offsets):
 
-				zdRec = pickle.loads(zlib.decompress(lrec[curr_pos]))
+	# Labels of the records concatenated in arena, record i ends at arena[offsets[i]]. The whole arena is scanned by the compiled scanner
+	starts = np.zeros(len(offsets) + 1, dtype=np.int64)
+	starts[1:] = np.frombuffer(offsets, dtype=np.int64)
 
-				writer.write(zdRec)
+	labels, found = scan_labels(np.frombuffer(arena, dtype=np.uint8), starts)
 
-				num_record_worker += 1
-				num_record_total += 1
+	for j in np.flatnonzero(~found).tolist(): labels[j] = label_example(bytes(arena[starts[j]:starts[j + 1]]))
 
-				if (num_record_total % num_records_print == 0): print("--> Written " + str(num_record_total) + " / " + str(num_records) + " records to final location (2/2)")
+	return array.array('q', labels.tobytes())
 
-				if (num_record_worker >= num_records_per_thread):
+def count_labels(labels):
 
-					worker_id += 1
-					num_record_worker = 0
+	# Count how many records there are per class, return the class ids and their counts
+	labels = np.frombuffer(labels, dtype=np.int64)
 
-					writer.close()
+	if ((len(labels) != 0) and (labels.min() >= 0) and (labels.max() <= len(labels))): # Dense class ids
 
-					output_examples = output_pattern_prefix + "-" + "{:05d}".format(worker_id) + "-of-" + "{:05d}".format(direct_num_workers) + ".tfrecord.gz"
-					writer = tf.python_io.TFRecordWriter(output_examples, options=tf.python_io.TFRecordOptions(compression))
+		label_counts = np.bincount(labels)
+		label_ids = np.flatnonzero(label_counts)
+		label_counts = label_counts[label_ids]
 
-	print("-> Create DeepVariant summary file")
+	else: label_ids, label_counts = np.unique(labels, return_counts=True)
+
+	return label_ids.tolist(), label_counts.tolist()
+
+def read_tfrecords(task, reader_options, batch_size, shuffle_key, seed, keep_records, no_mem_compression, run_size, tmp_prefix, no_tmp_compression):
+
+	# Hash and label the records of one input file, runs in a worker process. Records are returned too if keep_records is set, zstd compressed unless no_mem_compression.
+	# Otherwise, if run_size is set, records are sorted by runs of run_size records which are spilled to tmp files as they are read
+	file_index, fn = task
+
+	num_records = 0
+	hashes = array.array('Q') # Hashes of the records not spilled yet
+	labels = array.array('q')
+	arena = bytearray()
+	offsets = array.array('q') # Record i of the file ends at arena[offsets[i]]
+	lrec = [] # Records not spilled yet
+	compress = zstd.ZstdCompressor(level=1).compress # Records are decompressed protos, compressing them keeps a fraction of their size in memory
+	raw_arena = keep_records and no_mem_compression
+	runs = [] # Tmp files written
+	tmp_ext = ".bin" if no_tmp_compression else ".zst"
+
+	# Hot loop: hashing is inlined and attribute lookups are hoisted out of it
+	from_bytes = int.from_bytes
+	hashes_extend = hashes.extend
+	labels_extend = labels.extend
+	offsets_append = offsets.append
+	use_sha1 = (shuffle_key == 'sha1')
+	xxh3_64 = functools.partial(xxhash.xxh3_64_intdigest, seed=seed)
+	# Random keys are drawn from a generator seeded by (seed, file index) so they do not depend on which worker reads the file
+	bit_generator = np.random.default_rng([seed, file_index]).bit_generator if (shuffle_key == 'random') else None
+
+	try:
+
+		for batch in prefetch(read_batches([fn], reader_options, batch_size, True), 2):
+
+			# Records are shuffled on a 64 bits hash: xxh3, or SHA-1 truncated to its first 64 bits which sorts in the same order as the full digest
+			# Random keys skip hashing altogether: the order is then reproducible from the seed but not from the content of the records
+			if (bit_generator is not None): hashes.frombytes(bit_generator.random_raw(len(batch)).tobytes())
+			elif (use_sha1): hashes_extend([from_bytes(d[:8], 'big') for d in map(sha1_digest, map(sha1, batch))])
+			else: hashes_extend(map(xxh3_64, batch))
+
+			if (keep_records):
+
+				for rec in (batch if no_mem_compression else map(compress, batch)):
+
+					arena += rec
+					offsets_append(len(arena))
+
+			# Records already sit contiguously in the arena when they are kept raw: they are labeled all at once afterwards if Numba is available.
+			# Otherwise they are labeled here by label_example(), the protobuf parser unless protobuf runs in pure Python
+			if ((not raw_arena) or (numba is None)): labels_extend(map(label_example, batch))
+
+			if (run_size is not None):
+
+				lrec.extend(batch)
+
+				while (len(lrec) >= run_size): # Input index of the records is (file index, index in file) packed in 64 bits
+
+					fon = tmp_prefix + "_tmp_" + str(file_index) + "_" + str(len(runs)) + tmp_ext
+
+					runs.append(fon)
+					write_run(fon, lrec[:run_size], np.frombuffer(hashes[:run_size], dtype=np.uint64), (file_index << 32) + num_records, no_tmp_compression)
+
+					num_records += run_size
+
+					del lrec[:run_size]
+					del hashes[:run_size]
+
+		if (run_size is None): num_records = len(hashes)
+		elif (len(lrec) != 0):
+
+			fon = tmp_prefix + "_tmp_" + str(file_index) + "_" + str(len(runs)) + tmp_ext
+
+			runs.append(fon)
+			write_run(fon, lrec, np.frombuffer(hashes, dtype=np.uint64), (file_index << 32) + num_records, no_tmp_compression)
+
+			num_records += len(lrec)
+
+			del lrec[:]
+			del hashes[:]
+
+	except BaseException:
+
+		remove_tmp_files(runs) # Do not leave the runs of a failed worker behind
+
+		raise
+
+	if (raw_arena and (numba is not None)): labels = label_arena(arena, offsets)
+
+	label_ids, label_counts = count_labels(labels)
+
+	return num_records, hashes, label_ids, label_counts, arena, offsets, runs
+
+def write_frames(fon, frames, no_tmp_compression):
+
+	# Write (hash, input index, record) tuples to a tmp file. Each record is a frame (hash, input index, size) + record, zstd compressed unless no_tmp_compression
+	fo = open(fon, "wb")
+
+	if (not no_tmp_compression): fo = zstd.ZstdCompressor(level=1).stream_writer(fo)
+
+	for h, i, rec in frames:
+
+		fo.write(struct.pack('<QQQ', h, i, len(rec)))
+		fo.write(rec)
+
+	fo.close()
+
+def write_run(fon, lrec, lhash, start, no_tmp_compression):
+
+	# Write a chunk of records sorted by hash to a tmp file
+	order = np.argsort(lhash, kind='stable')
+
+	write_frames(fon, zip(lhash[order].tolist(), (order + start).tolist(), map(lrec.__getitem__, order.tolist())), no_tmp_compression)
+
+def read_run(fon, no_tmp_compression):
+
+	# Iterate over the (hash, input index, record) frames of a tmp file written by write_run. The file is memory-mapped so records are sliced from the page cache without read syscalls
+	with open(fon, "rb") as fo: mm = mmap.mmap(fo.fileno(), 0, prot=mmap.PROT_READ)
+
+	mm.madvise(mmap.MADV_SEQUENTIAL)
+
+	if (no_tmp_compression):
+
+		off = 0
+
+		while (off + 24 <= len(mm)):
+
+			h, i, sz = struct.unpack_from('<QQQ', mm, off)
+
+			yield h, i, mm[off + 24:off + 24 + sz]
+
+			off += 24 + sz
+
+	else:
+
+		fo = zstd.ZstdDecompressor().stream_reader(mm)
+		header = fo.read(24)
+
+		while (len(header) == 24):
+
+			h, i, sz = struct.unpack('<QQQ', header)
+
+			yield h, i, fo.read(sz)
+
+			header = fo.read(24)
+
+		fo.close()
+
+	mm.close()
+
+def remove_tmp_files(runs):
+
+	# Remove the tmp files listed in runs, some may not have been created yet
+	for fon in runs:
+
+		if (os.path.exists(fon)): os.remove(fon)
+
+	del runs[:]
+
+def merge_runs(runs, tmp_prefix, no_tmp_compression, max_open_runs):
+
+	# Merge tmp files by groups of max_open_runs into larger runs until at most max_open_runs of them are left, so that no merge opens more files at once.
+	# runs is updated in place as tmp files are created and removed so the caller always knows which ones are left to clean
+	num_merges = 0
+	tmp_ext = ".bin" if no_tmp_compression else ".zst"
+
+	while (len(runs) > max_open_runs):
+
+		print("--> Merging " + str(max_open_runs) + " of " + str(len(runs)) + " tmp files")
+
+		group = runs[:max_open_runs]
+		fon = tmp_prefix + "_tmp_merge_" + str(num_merges) + tmp_ext
+
+		runs.append(fon)
+
+		write_frames(fon, heapq.merge(*[read_run(fin, no_tmp_compression) for fin in group]), no_tmp_compression)
+
+		for fin in group: os.remove(fin)
+
+		del runs[:max_open_runs]
+
+		num_merges += 1
+
+def masked_crc32c(data):
+
+	# Masked CRC32-C of the TFRecord format
+	crc = crc32c.crc32c(data)
+
+	return (((crc >> 15) | (crc << 17)) + 0xa282ead8) & 0xffffffff
+
+def deflate_chunk(chunk, dictionary, compression_level):
+
+	# Raw deflate of a chunk, primed with the end of the previous chunk and flushed on a byte boundary so deflated chunks can be concatenated
+	compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary) if (len(dictionary) != 0) else zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+	return chunk, compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+class PigzWriter:
+
+	# Drop-in replacement of tf.io.TFRecordWriter for GZIP output where compression is spread over a pool of threads, like pigz.
+	# TF records are framed here, buffered in chunks of chunk_size bytes and each chunk is deflated by a thread (zlib releases the GIL).
+	# Deflated chunks are written in order to a single gzip member so the output is a regular gzip file.
+
+	def __init__(self, path, executor, compression_level, chunk_size=1 << 20, max_pending=16):
 
-	# Get absolute path prefix from output_pattern_prefix and input_pattern_list files
-	output_examples = output_pattern_prefix + "-00000-of-" + "{:05d}".format(direct_num_workers) + ".tfrecord.gz"
-	abspath_output_examples = os.path.abspath(output_examples)
-	abspath_out_prefix_sz = len(abspath_output_examples) - len(output_examples)
+		self.fo = open(path, "wb")
+		self.executor = executor
+		self.compression_level = compression_level
+		self.chunk_size = chunk_size
+		self.max_pending = max_pending
+
+		self.buf = [] # Framed records of the current chunk
+		self.buf_size = 0
+		self.dictionary = b"" # Last 32 KiB of the previous chunk
+		self.pending = collections.deque() # Chunks being deflated, in output order
+		self.crc = 0 # CRC-32 and size of the uncompressed data, for the gzip trailer
+		self.size = 0
+
+		self.fo.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff") # gzip header: deflate, no flags, no mtime, unknown OS
+
+	def write(self, rec):
+
+		header = struct.pack('<Q', len(rec))
+
+		self.buf.extend((header, struct.pack('<I', masked_crc32c(header)), rec, struct.pack('<I', masked_crc32c(rec))))
+		self.buf_size += len(rec) + 16
+
+		if (self.buf_size >= self.chunk_size): self.submit_chunk()
+
+	def submit_chunk(self):
+
+		chunk = b"".join(self.buf)
+
+		self.buf = []
+		self.buf_size = 0
+
+		self.pending.append(self.executor.submit(deflate_chunk, chunk, self.dictionary, self.compression_level))
+		self.dictionary = chunk[-(1 << zlib.MAX_WBITS):]
+
+		while (len(self.pending) > self.max_pending): self.write_chunk()
+
+	def write_chunk(self):
+
+		chunk, deflated = self.pending.popleft().result()
+
+		self.crc = zlib.crc32(chunk, self.crc)
+		self.size += len(chunk)
+
+		self.fo.write(deflated)
+
+	def close(self):
+
+		if (self.buf_size != 0): self.submit_chunk()
+
+		while (len(self.pending) != 0): self.write_chunk()
+
+		self.fo.write(zlib.compressobj(self.compression_level, zlib.DEFLATED, -zlib.MAX_WBITS).flush()) # Final empty deflate block
+		self.fo.write(struct.pack('<II', self.crc, self.size & 0xffffffff)) # gzip trailer
+		self.fo.close()
+
+def write_shards(records, output_pattern_prefix, direct_num_workers, num_records, writer_options, output_threads, location):
+
+	# Write the records to direct_num_workers output files. Records are produced in a background thread while this one compresses and writes them
+	worker_id = 0
+	num_record_worker = 0
+	num_record_total = 0
+	num_records_per_thread = int(num_records / direct_num_workers) + 1
+	num_records_print = max(1, int(num_records / 20))
+
+	executor = concurrent.futures.ThreadPoolExecutor(output_threads) if (output_threads > 1) else None
+
+	def open_writer(output_examples):
+
+		if (executor is None): return tf.io.TFRecordWriter(output_examples, writer_options)
+
+		return PigzWriter(output_examples, executor, writer_options.compression_level, max_pending=2 * output_threads)
+
+	output_examples = output_pattern_prefix + "-" + "{:05d}".format(worker_id) + "-of-" + "{:05d}".format(direct_num_workers) + ".tfrecord.gz"
+	writer = open_writer(output_examples)
+
+	for rec in prefetch(records):
+
+		writer.write(rec)
+
+		num_record_worker += 1
+		num_record_total += 1
+
+		if (num_record_total % num_records_print == 0): print("--> Written " + str(num_record_total) + " / " + str(num_records) + " records to " + location)
+
+		if (num_record_worker >= num_records_per_thread):
+
+			worker_id += 1
+			num_record_worker = 0
+
+			writer.close()
+
+			output_examples = output_pattern_prefix + "-" + "{:05d}".format(worker_id) + "-of-" + "{:05d}".format(direct_num_workers) + ".tfrecord.gz"
+			writer = open_writer(output_examples)
+
+	writer.close()
+
+	if (executor is not None): executor.shutdown()
+
+def shuffle_tfrecords(dataset_name, input_filename_pattern_list, output_pattern_prefix, output_config_filename, direct_num_workers, num_readers, step, shuffle_key, seed, no_mem_compression, no_tmp_compression, tmp_dir, compression_level, output_threads):
+
+	i = 0
+	num_records = 0
+	hashes = array.array('Q') # Hash of each record, in input order (step == -1)
+	label_counts = {}
+	lfn = []
+	arena = bytearray() # Records concatenated in input order when all of them are loaded in memory (step == -1), each one zstd compressed unless no_mem_compression
+	offsets = array.array('q', [0]) # Record i is arena[offsets[i]:offsets[i+1]]
+	runs = [] # Tmp files of sorted records (step != -1)
+	# TF records options are created once and shared by all readers and writers.
+	# GZIP is the main cost of writing: use a fast compression level by default and large zlib buffers
+	reader_options = tf.io.TFRecordOptions(compression_type="GZIP")
+	writer_options = tf.io.TFRecordOptions(compression_type="GZIP", compression_level=compression_level, input_buffer_size=4 << 20, output_buffer_size=4 << 20)
+	batch_size = 1024 # Number of records hashed and labeled per call, amortizes the per-record interpreter overhead
+
+	# Make sure we process the input files always in the same order
+	for idx, filepattern in enumerate(input_filename_pattern_list): lfn.extend(glob.glob(filepattern))
+		
+	if (len(lfn) == 0): sys.exit("No file found matching input pattern list. Shuffling aborted.")
+	if ((output_threads > 1) and (crc32c is None)): sys.exit("--output_threads requires the crc32c module (pip3 install crc32c). Shuffling aborted.")
+
+	lfn.sort()
+
+	num_processes = max(1, min(num_readers, len(lfn)))
+
+	if (step == -1): run_size = None # User explicitly instructed to load ALL records in memory
+	else: run_size = max(1, int(step / num_processes)) # User explicitely gave the number of TF records that could be loaded in memory at once, shared by the workers
+
+	tmp_prefix = output_pattern_prefix if (tmp_dir is None) else os.path.join(tmp_dir, os.path.basename(output_pattern_prefix))
+	tmp_ext = ".bin" if no_tmp_compression else ".zst"
+
+	# Hash records and compute their labels. With --step, records are also sorted by runs and spilled to tmp storage in the same pass
+	print("-> Reading input")
+
+	# Input files are processed in parallel by num_readers processes, results come back in input order.
+	# Spawn rather than fork the workers: TensorFlow is not fork-safe. A single reader runs in this process, no pool is spawned.
+	read_file = functools.partial(read_tfrecords, reader_options=reader_options, batch_size=batch_size, shuffle_key=shuffle_key, seed=seed, keep_records=(step == -1), no_mem_compression=no_mem_compression, run_size=run_size, tmp_prefix=tmp_prefix, no_tmp_compression=no_tmp_compression)
+
+	try:
+
+		pool = multiprocessing.get_context('spawn').Pool(num_processes) if (num_processes > 1) else None
+
+		try:
+
+			for file_num_records, file_hashes, file_label_ids, file_label_counts, file_arena, file_offsets, file_runs in (map(read_file, enumerate(lfn)) if (pool is None) else pool.imap(read_file, enumerate(lfn))):
+
+				hashes.extend(file_hashes)
+				runs.extend(file_runs)
+
+				for label, count in zip(file_label_ids, file_label_counts): label_counts[label] = label_counts.get(label, 0) + count
+
+				if (step == -1):
+
+					offsets.frombytes((np.frombuffer(file_offsets, dtype=np.int64) + len(arena)).tobytes())
+					arena += file_arena
+
+				i += file_num_records
+
+				del file_arena
+
+		except BaseException:
+
+			if (pool is not None): # Readers stopped by terminate() cannot remove their tmp files, nor report those of files not consumed yet: find them by name
+
+				pool.terminate()
+
+				for file_index in range(len(lfn)): runs.extend(glob.glob(glob.escape(tmp_prefix + "_tmp_" + str(file_index) + "_") + "*" + tmp_ext))
+
+			raise
+
+		finally:
+
+			if (pool is not None): pool.terminate()
+
+		num_records = i
+
+		# Count how many labels there are (total and per class)
+		print("-> Counting labels")
+
+		num_examples = sum(label_counts.values())
+		num_examples_by_labels = "".join("# class" + str(label) + ": " + str(label_counts[label]) + '\n' for label in sorted(label_counts))
+
+		del label_counts
+
+		if (step == -1): # User explicitly instructed to load ALL records in memory
+
+			print("-> Shuffling TF records")
+
+			records = np.argsort(np.frombuffer(hashes, dtype=np.uint64), kind='stable') # Input position of the records sorted by their hash
+
+			del hashes
+
+			# Position of the shuffled records in the arena, gathered at once rather than looked up record by record
+			offsets = np.frombuffer(offsets, dtype=np.int64)
+			starts = offsets[records]
+			ends = offsets[records + 1]
+
+			del records
+			del offsets
+
+			def shuffled_records():
+
+				decompress = bytes if no_mem_compression else zstd.ZstdDecompressor().decompress
+
+				# Converted to Python ints one batch at a time, a list of all positions would take much more memory than the arrays
+				for k in range(0, num_records, batch_size):
+
+					for start, end in zip(starts[k:k + batch_size].tolist(), ends[k:k + batch_size].tolist()): yield decompress(arena[start:end])
+
+			# Write shuffled records to disk
+			print("-> Writing shuffled TF records to output")
+
+			arena = memoryview(arena)
+
+			write_shards(shuffled_records(), output_pattern_prefix, direct_num_workers, num_records, writer_options, output_threads, "final location")
+
+		else: # Runs of sorted records were spilled to tmp storage while reading the input
+
+			# Write shuffled records to disk
+			print("-> Merging shuffled TF records from " + str(len(runs)) + " tmp files to output")
+
+			# Each tmp file read holds a file descriptor: cap how many are merged at once well below the limit of open files
+			max_open_files = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+			max_open_runs = 128 if (max_open_files == resource.RLIM_INFINITY) else max(2, min(128, max_open_files // 4))
+
+			merge_runs(runs, tmp_prefix, no_tmp_compression, max_open_runs)
+
+			# Records are merged on (hash, input index) so the order is the same as a stable sort of all records in memory
+			lruns = [read_run(fon, no_tmp_compression) for fon in runs]
+
+			write_shards((rec for h, j, rec in heapq.merge(*lruns)), output_pattern_prefix, direct_num_workers, num_records, writer_options, output_threads, "final location")
+
+	finally:
+
+		# Tmp files are removed whether the merge succeeded or not
+		if (len(runs) != 0): print("-> Clean tmp files")
+
+		remove_tmp_files(runs)
+
+	print("-> Create DeepVariant summary file")
 
-	abspath_input_examples = os.path.abspath(lfn[0])
-	abspath_in_prefix_sz = len(abspath_input_examples) - len(input_pattern_list)
-	
-	if (abspath_out_prefix_sz != 0): output_pattern_prefix = abspath_output_examples[0:abspath_out_prefix_sz] + output_pattern_prefix
-	if (abspath_in_prefix_sz != 0): input_pattern_list = abspath_input_examples[0:abspath_in_prefix_sz] + input_pattern_list
+	# Write absolute paths of the output prefix and of each input pattern to the summary file
+	output_pattern_prefix = os.path.abspath(output_pattern_prefix)
+	input_pattern_list = ",".join(os.path.abspath(filepattern) for filepattern in input_filename_pattern_list)
 
 	# Create summary file
 	fo = open(output_config_filename, "w")
@@ -343,6 +814,8 @@ def shuffle_tfrecords(dataset_name, input_filename_pattern_list, input_pattern_l
 	fo.write("#\n")
 	fo.write("# --input_pattern_list=" + input_pattern_list + "\n") # Write input file pattern
 	fo.write("# --output_pattern_prefix=" + output_pattern_prefix + "\n") # Write output file pattern
+	fo.write("# --shuffle_key=" + shuffle_key + "\n") # Write shuffle key and seed so the shuffle can be reproduced
+	fo.write("# --seed=" + str(seed) + "\n")
 	fo.write("#\n")
 	fo.write(num_examples_by_labels) # Write number of examples by label
 
@@ -357,9 +830,16 @@ if __name__ == '__main__':
 	input_examples = shuffle_tfrecords(
 		known_args.output_dataset_name,
 		known_args.input_pattern_list.split(','),
-		known_args.input_pattern_list,
 		known_args.output_pattern_prefix,
 		known_args.output_dataset_config_pbtxt,
 		known_args.direct_num_workers,
-		known_args.step
+		known_args.num_readers,
+		known_args.step,
+		known_args.shuffle_key,
+		known_args.seed,
+		known_args.no_mem_compression,
+		known_args.no_tmp_compression,
+		known_args.tmp_dir,
+		known_args.compression_level,
+		known_args.output_threads
 	)